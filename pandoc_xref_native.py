@@ -26,34 +26,65 @@ import io
 import re
 import subprocess
 import json
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Optional
 
 import inflect
 from bs4 import BeautifulSoup
-from pandocfilters import walk, RawInline, Str
+
+# orjson is optional. If it is installed, it is used to parse and serialize the
+# document, which is considerably faster than the json module for large
+# documents.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 #------------------------------------------------------------------------------
 # Common utility items --------------------------------------------------------
 #------------------------------------------------------------------------------
 
-section_ids = []
-equation_ids = []
-figure_ids = []
-table_ids = []
+# Ids must conform to
+# `HTML naming rules <https://www.w3.org/TR/html4/types.html>`_ for IDs. In
+# addition, it is required that IDs do not end with a period, colon, or comma,
+# otherwise it would not be possible to write a cross-reference of the
+# following kind::
+#
+#     A cross-reference at the end of a sentence: @#id.
+#
+# The period/colon/comma would need to be separated from the ID by a space,
+# which would be awkward. Periods/colons are fine as long as they are not the
+# last character of the ID.
+ID_RE = r'(?P<id>[a-zA-Z][a-zA-Z0-9-_:\.]*(?<=[a-zA-Z0-9-_]))'
 
-"""
-Ids must conform to
-`HTML naming rules <https://www.w3.org/TR/html4/types.html>`_ for IDs. In
-addition, it is required that IDs do not end with a period, colon, or comma,
-otherwise it would not be possible to write a cross-reference of the following
-kind::
 
-    A cross-reference at the end of a sentence: @#id.
+@dataclass
+class XrefState:
+    """State of pandoc-xref-native for a single document.
 
-The period/colon/comma would need to be separated from the ID by a space, which
-would be awkward. Periods/colons are fine as long as they are not the last
-character of the ID.
-"""
-ID_RE = r'(?P<id>[a-zA-Z][a-zA-Z0-9-_:\.]*(?<=[a-zA-Z0-9-_]))'
+    Keeping all state in an instance of this class rather than in module
+    globals allows multiple documents to be filtered independently (and
+    concurrently).
+    """
+
+    section_ids: list = field(default_factory=list)
+    equation_ids: list = field(default_factory=list)
+    figure_ids: list = field(default_factory=list)
+    table_ids: list = field(default_factory=list)
+    # Maps every (unique) ID to its type. Populated by `map_ids_to_types` once
+    # all IDs have been collected, and used to look up the type of
+    # cross-referenced IDs.
+    id_to_type: dict = field(default_factory=dict)
+    # Bracket states used by `CrossRef`.
+    inside_brackets: bool = False
+    bracketed_type: Optional[str] = None
+
+    def reset_bracket_states(self):
+        """Set bracket states to default values."""
+        self.inside_brackets = False
+        self.bracketed_type = None
 
 
 def pandoc(string, para=True):
@@ -105,42 +136,64 @@ def tab_id(table):
 
 
 # pylint: disable=unused-argument
-# Function `walk` from module `pandocfilters` expects to be passed a function
-# which accepts arguments `key, value, format, meta`.
-def collect_ids(key, value, _format, meta):
+# Function `apply_filter` (like `walk` from module `pandocfilters`) expects to
+# be passed a function which accepts arguments `key, value, format, meta`. The
+# state needs to be bound using `functools.partial`.
+def collect_ids(state, key, value, _format, meta):
     """Add IDs found in document to their respective ID lists.
 
     Add IDs found in headings, equations, figures, and tables to their
-    respective ID lists.
+    respective ID lists. IDs are interned, so that looking them up when
+    resolving cross-references (whose IDs are interned too) is cheaper.
     """
     if key == 'Header':
         # Headings always have IDs as pandoc autogenerates them if not
         # supplied explicitly.
-        section_ids.append(sec_id(value))
+        state.section_ids.append(sys.intern(sec_id(value)))
 
     if key == 'RawInline':
-        if eq_id(value) is not None:
-            equation_ids.append(eq_id(value))
+        _id = eq_id(value)
+        if _id is not None:
+            state.equation_ids.append(sys.intern(_id))
 
     if key == 'Figure':
-        if fig_id(value) is not None:
-            figure_ids.append(fig_id(value))
+        _id = fig_id(value)
+        if _id is not None:
+            state.figure_ids.append(sys.intern(_id))
 
     if key == 'Table':
-        if tab_id(value) is not None:
-            table_ids.append(tab_id(value))
+        _id = tab_id(value)
+        if _id is not None:
+            state.table_ids.append(sys.intern(_id))
 
 
-def check_id_uniqueness():
+def check_id_uniqueness(state):
     """Check if IDs found in document are unique and remove duplicate IDs."""
-    ids = section_ids + equation_ids + figure_ids + table_ids
-    freqs = [ ids.count(_id) for _id in ids ]
-    duplicates = { _id for _id, freq in zip(ids, freqs) if freq > 1 }
+    id_lists = [state.section_ids, state.equation_ids, state.figure_ids,
+                state.table_ids]
+    ids = [ _id for id_list in id_lists for _id in id_list ]
+    duplicates = { _id for _id, freq in Counter(ids).items() if freq > 1 }
     for duplicate in duplicates:
         eprint(f'pandoc-xref-native: ID { duplicate } was defined more '
                 'than once!')
-        for id_list in [section_ids, equation_ids, figure_ids, table_ids]:
-            id_list[:] = [ _id for _id in id_list if _id not in duplicates ]
+    if not duplicates:
+        return
+    for id_list in id_lists:
+        id_list[:] = [ _id for _id in id_list if _id not in duplicates ]
+
+
+def map_ids_to_types(state):
+    """Populate `state.id_to_type` from the ID lists.
+
+    Must be called after `check_id_uniqueness`, so that duplicate IDs are not
+    mapped to any type.
+    """
+    state.id_to_type.clear()
+    for _type, id_list in [('section', state.section_ids),
+                           ('equation', state.equation_ids),
+                           ('figure', state.figure_ids),
+                           ('table', state.table_ids)]:
+        state.id_to_type.update(dict.fromkeys(id_list, _type))
 
 
 # -----------------------------------------------------------------------------
@@ -152,7 +205,8 @@ inflect_engine = inflect.engine()
 def pluralize(_type):
     """Return plural form of type.
 
-    Used by `cross_ref.__calc_type()`.
+    Not currently used by the filter itself, since types are pluralized in
+    HTML by `crossrefs.js` (for cross-references with class `pluralize`).
     """
     if _type[-1] == '.':
         return inflect_engine.plural(_type[:-1]) + '.'
@@ -166,6 +220,12 @@ class CrossRef:
     # There is no elegant way to reduce the number of instance arguments.
     # Furthermore, it doesn't really cause readability issues in this case.
 
+    # A CrossRef instance is created for every cross-reference in the
+    # document, so a __dict__ per instance is avoided.
+    __slots__ = ('state', 'match_object', 'known_abbreviation',
+                 'type_suppressor', 'id', 'opening_bracket', 'closing_bracket',
+                 'punctuation', 'valid', 'type', 'starts_sentence')
+
     # Pandoc will replace spaces after known abbreviations with non-breaking
     # spaces (\xa0) (see https://pandoc.org/MANUAL.html#reader-options, under
     # --abbreviations=FILE). If the cross-reference is preceded by a known
@@ -179,30 +239,30 @@ class CrossRef:
            r'(?P<closing_bracket>\])??'
            r'(?P<punctuation>[^a-zA-Z0-9-_\[\]]*?)$')
 
-    inside_brackets = False
-    __bracketed_type = None
-
     @staticmethod
-    def match(string):
+    def match(string, state):
         """Return CrossRef instance if string matches crossref regex."""
-        match_object = re.match(CrossRef.re, string)
-        return CrossRef(match_object) if match_object else None
-
+        # Most Strs in a document aren't cross-references. A substring search
+        # is much cheaper than running the regex on them.
+        if '@#' not in string:
+            return None
+        match_object = _CROSSREF_RE.match(string)
+        return CrossRef(match_object, state) if match_object else None
 
-    @staticmethod
-    def reset_bracket_states():
-        """Set bracket states to default values."""
-        CrossRef.inside_brackets = False
-        CrossRef.__bracketed_type = None
 
+    def __init__(self, match_object, state):
+        """Initialize CrossRef instance.
 
-    def __init__(self, match_object):
-        """Initialize CrossRef instance."""
+        The bracket states kept in `state` are updated based on this
+        cross-reference.
+        """
+        self.state = state
         self.match_object = match_object
         self.known_abbreviation = match_object.group('known_abbreviation')
         self.type_suppressor = match_object.group('type_suppressor')
         # pylint thinks 'id' is too short for a name.
-        self.id = match_object.group('id') # pylint: disable=invalid-name
+        # pylint: disable-next=invalid-name
+        self.id = sys.intern(match_object.group('id'))
         self.opening_bracket = match_object.group('opening_bracket')
         self.closing_bracket = match_object.group('closing_bracket')
         self.punctuation = match_object.group('punctuation')
@@ -219,16 +279,7 @@ class CrossRef:
 
     def __find_type(self):
         """Determine type (section/figure/...) of ID belonging to crossref."""
-        if   self.id in section_ids:
-            self.type = 'section'
-        elif self.id in equation_ids:
-            self.type = 'equation'
-        elif self.id in figure_ids:
-            self.type = 'figure'
-        elif self.id in table_ids:
-            self.type = 'table'
-        else:
-            self.type = None
+        self.type = self.state.id_to_type.get(self.id)
 
 
     def __check(self):
@@ -236,7 +287,7 @@ class CrossRef:
         # Prefix suppressor and opening bracket may not both be present.
         if ( self.type_suppressor and
                           (self.opening_bracket or self.closing_bracket
-                                                or CrossRef.inside_brackets) ):
+                                            or self.state.inside_brackets) ):
             eprint( 'pandoc-xref-native: A type suppressor (-) cannot be '
                     'used in combination with brackets: '
                    f'{ self.match_object.group() }')
@@ -253,7 +304,7 @@ class CrossRef:
 
         # An opening bracket may not appear before the previous opening bracket
         # has been closed.
-        if self.opening_bracket and self.inside_brackets:
+        if self.opening_bracket and self.state.inside_brackets:
             eprint( 'pandoc-xref-native: Another opening bracket cannot be '
                     'used before the previous opening bracket has been closed:'
                    f' { self.match_object.group() }')
@@ -269,12 +320,12 @@ class CrossRef:
             # might be inserted as a raw element by another filter.
 
         # Check if crossrefs in brackets are all of the same type.
-        if (not CrossRef.__bracketed_type is self.type
-                                    and CrossRef.__bracketed_type is not None):
+        if (not self.state.bracketed_type is self.type
+                                    and self.state.bracketed_type is not None):
             eprint(f'pandoc-xref-native: { self.type.capitalize() } ID '
                    f'{ self.id } is inside brackets, but is not of the same '
                     'type as the previous bracketed cross-reference '
-                   f'(which was a { self.__bracketed_type })!')
+                   f'(which was a { self.state.bracketed_type })!')
             self.valid = False
             return
 
@@ -284,21 +335,22 @@ class CrossRef:
     def __set_bracket_states(self):
         """Set bracket states based on current CrossRef instance."""
         if self.opening_bracket:
-            CrossRef.inside_brackets = True
+            self.state.inside_brackets = True
         if self.closing_bracket:
-            CrossRef.inside_brackets = False
-            CrossRef.__bracketed_type = None
+            self.state.inside_brackets = False
+            self.state.bracketed_type = None
         # In case the first bracketed cross-reference couldn't be resolved,
-        # self.__bracketed_type needs to be updated for any following
+        # self.state.bracketed_type needs to be updated for any following
         # bracketed cross-references.
-        if CrossRef.inside_brackets and self.type is not None:
-            CrossRef.__bracketed_type = self.type
+        if self.state.inside_brackets and self.type is not None:
+            self.state.bracketed_type = self.type
 
 
     def html(self):
         """Return HTML."""
+        inside_brackets = self.state.inside_brackets
         include_type = self.opening_bracket or (not self.type_suppressor
-                                             and not (CrossRef.inside_brackets
+                                             and not (inside_brackets
                                                       # self.closing_bracket
                                                       # has already been set to
                                                       # False for last item in
@@ -312,14 +364,23 @@ class CrossRef:
              '??'
              '</a>')
 
-        elts = [ RawInline("html", html) ]
+        # AST elements are constructed directly rather than using the
+        # constructors from module `pandocfilters`. See
+        # https://hackage.haskell.org/package/pandoc-types/docs/Text-Pandoc-Definition.html
+        # for the structure of Pandoc's AST.
+        elts = [ {'t': 'RawInline', 'c': ['html', html]} ]
         if self.known_abbreviation:
-            elts.insert(0, Str(self.known_abbreviation))
+            elts.insert(0, {'t': 'Str', 'c': self.known_abbreviation})
         if self.punctuation:
-            elts.append(Str(self.punctuation))
+            elts.append({'t': 'Str', 'c': self.punctuation})
         return elts
 
 
+# The class attribute `re` shadows the `re` module inside the class body, so
+# the compiled pattern is kept at module level.
+_CROSSREF_RE = re.compile(CrossRef.re)
+
+
 def new_sentence(previous_items):
     r"""Detect if item is starting a new sentence by looking at previous items.
 
@@ -338,32 +399,41 @@ def new_sentence(previous_items):
     if previous_items:
         not_a_space = previous_items[-2]
         return ( not_a_space['t'] == 'Str'
-                              and re.match(r'^.*[\.!\?:]$', not_a_space['c']) )
+                 and not_a_space['c'].endswith(('.', '!', '?', ':')) )
     return True
 
 
 # pylint: disable=unused-argument
-# Function `walk` from module `pandocfilters` expects to be passed a function
-# which accepts arguments `key, value, format, meta`.
-def resolve_crossrefs(key, value, _format, meta):
+# Function `apply_filter` (like `walk` from module `pandocfilters`) expects to
+# be passed a function which accepts arguments `key, value, format, meta`. The
+# state needs to be bound using `functools.partial`.
+def resolve_crossrefs(state, key, value, _format, meta):
     """Resolve cross-references found in document."""
     if not isinstance(value, list):
         return None
 
+    # Most lists don't contain any cross-references, which is cheaper to check
+    # for in a single pass than by matching every Str below. Not resetting the
+    # bracket states in this case is fine, since they are reset for every list
+    # anyway (brackets cannot span multiple lists).
+    if not any(isinstance(elt, dict) and elt.get('t') == 'Str'
+                                     and '@#' in elt['c'] for elt in value):
+        return None
+
     elts = value
-    CrossRef.reset_bracket_states()
+    state.reset_bracket_states()
     for i, elt in enumerate(elts):
         if not ( isinstance(elt, dict) and 't' in elt and elt['t'] == 'Str' ):
             continue
 
-        cross_ref = CrossRef.match(elt['c'])
+        cross_ref = CrossRef.match(elt['c'], state)
         if not (cross_ref and cross_ref.valid):
             continue
 
         cross_ref.starts_sentence = new_sentence(elts[:i])
         elts[i:i+1] = cross_ref.html()
 
-    if CrossRef.inside_brackets:
+    if state.inside_brackets:
         eprint( 'pandoc-xref-native: Missing closing bracket after'
                f'cross-reference: { cross_ref.match_object.group() }')
 
@@ -381,13 +451,21 @@ def read_stdin():
     calling the filter, provided the filter is called with the `--filter`
     option rather than via pipes.
     """
-    input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    source = input_stream.read()
+    if orjson:
+        source = sys.stdin.buffer.read()
+        try:
+            doc = orjson.loads(source)
+        except orjson.JSONDecodeError:
+            # orjson refuses to parse documents nested more than 1024 levels
+            # deep.
+            doc = json.loads(source)
+    else:
+        input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+        doc = json.load(input_stream)
     if len(sys.argv) > 1:
         _format = sys.argv[1]
     else:
         _format = ""
-    doc = json.loads(source)
     return doc, _format
 
 
@@ -401,19 +479,73 @@ def compatible_output_format(_format):
     return _format in {'', 'html', 'native'}
 
 
+# Elements whose contents cannot contain any other elements, and thus need not
+# be traversed.
+OPAQUE_ELEMENTS = {'Code', 'CodeBlock', 'Math', 'RawBlock', 'RawInline'}
+
+
+def iter_elements(obj):
+    """Yield all AST elements (dicts with a 't' key) found in obj.
+
+    Elements are yielded in document order, each before its contents, which
+    means that the contents of an element may be modified in place by the
+    consumer before they are traversed. Just like `walk` from module
+    `pandocfilters`, only elements contained in lists are yielded.
+
+    An explicit stack is used instead of recursion, and the contents of
+    elements in `OPAQUE_ELEMENTS` are skipped.
+    """
+    stack = [(obj, False)]
+    while stack:
+        obj, in_list = stack.pop()
+        if isinstance(obj, list):
+            stack.extend((item, True) for item in reversed(obj))
+        elif isinstance(obj, dict):
+            if in_list and 't' in obj:
+                yield obj
+                if obj['t'] in OPAQUE_ELEMENTS:
+                    continue
+            stack.extend((value, False) for value in reversed(obj.values()))
+
+
 def apply_filter(_filter, doc, _format):
-    """Apply supplied filters to the document."""
+    """Apply supplied filter to the document in place.
+
+    Unlike `walk` from module `pandocfilters`, this doesn't rebuild the
+    document, so the return value of `_filter` is ignored. Filters need to
+    modify the elements' contents in place instead.
+    """
     if 'meta' in doc:
         meta = doc['meta']
     else:
         meta = {}
-    filtered_doc = walk(doc, _filter, _format, meta)
-    return filtered_doc
+    for elt in iter_elements(doc):
+        _filter(elt['t'], elt.get('c'), _format, meta)
 
 
 def write_stdout(doc):
-    """Write modified document to stdout."""
-    sys.stdout.write(json.dumps(doc))
+    """Write modified document to stdout.
+
+    The output is compact and non-ASCII characters are written as is, rather
+    than as escape sequences.
+    """
+    if orjson:
+        try:
+            output = orjson.dumps(doc)
+        except orjson.JSONEncodeError:
+            # orjson refuses to serialize documents nested more than 255
+            # levels deep, which deeply nested block quotes or lists can be.
+            output = None
+        if output is not None:
+            sys.stdout.buffer.write(output)
+            sys.stdout.buffer.flush()
+            return
+    output_stream = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    output_stream.write(
+        json.dumps(doc, ensure_ascii=False, separators=(',', ':')))
+    output_stream.flush()
+    # Prevent sys.stdout.buffer from being closed along with output_stream.
+    output_stream.detach()
 
 
 def main():
@@ -431,10 +563,12 @@ def main():
         write_stdout(doc)
         return
 
-    apply_filter(collect_ids, doc, _format)
-    check_id_uniqueness()
-    new_doc = apply_filter(resolve_crossrefs, doc, _format)
-    write_stdout(new_doc)
+    state = XrefState()
+    apply_filter(partial(collect_ids, state), doc, _format)
+    check_id_uniqueness(state)
+    map_ids_to_types(state)
+    apply_filter(partial(resolve_crossrefs, state), doc, _format)
+    write_stdout(doc)
 
 
 if __name__ == "__main__":
@@ -3,17 +3,20 @@
 """Tests for pandoc-xref-native."""
 
 import unittest
+import sys
+import os
 import json
 import subprocess
 import re
+from functools import partial
 
-from pandocfilters import Header, RawInline, Image, walk
+from pandocfilters import Header, RawInline, Image
 
-from pandoc_xref_native import section_ids, equation_ids, figure_ids, \
-                               table_ids, pandoc, sec_id, eq_id, fig_id, \
+from pandoc_xref_native import XrefState, pandoc, sec_id, eq_id, fig_id, \
                                tab_id, collect_ids, check_id_uniqueness, \
-                               pluralize, CrossRef, new_sentence, \
-                               resolve_crossrefs
+                               map_ids_to_types, pluralize, CrossRef, \
+                               new_sentence, resolve_crossrefs, \
+                               iter_elements, apply_filter
 
 # -----------------------------------------------------------------------------
 # Utility functions -----------------------------------------------------------
@@ -24,14 +27,6 @@ def mock_attr(_id):
     return [_id, [], []]
 
 
-def reset_idlists():
-    """Empty id lists imported from module `pandoc_xref_native`."""
-    section_ids[:] = []
-    equation_ids[:] = []
-    figure_ids[:] = []
-    table_ids[:] = []
-
-
 def depandoc(doc):
     """Turn Pandoc AST back into Pandoc's Markdown.
 
@@ -102,24 +97,35 @@ class TestPandocXrefNative(unittest.TestCase):
 
 
     def test_collect_ids(self):
-        reset_idlists()
+        state = XrefState()
         doc = pandoc(("# Header {#sec1}\n\n"
                       "![Figure caption](einstein.jpg){#fig1}"), para=False)
-        walk(doc, collect_ids, None, None)
-        self.assertEqual(section_ids, ['sec1'])
-        self.assertEqual(equation_ids, [])
-        self.assertEqual(figure_ids, ['fig1'])
+        apply_filter(partial(collect_ids, state), doc, None)
+        self.assertEqual(state.section_ids, ['sec1'])
+        self.assertEqual(state.equation_ids, [])
+        self.assertEqual(state.figure_ids, ['fig1'])
 
 
     def test_check_id_uniqueness(self):
-        reset_idlists()
-        section_ids[:] = ['killer_bunny', 'brian', 'brian', 'shrubbery']
-        figure_ids[:] = ['brian', 'balloon', 'ex-parrot']
-        table_ids[:] = ['balloon', 'airship']
-        check_id_uniqueness()
-        self.assertEqual(section_ids, ['killer_bunny', 'shrubbery'])
-        self.assertEqual(figure_ids, ['ex-parrot'])
-        self.assertEqual(table_ids, ['airship'])
+        state = XrefState(
+                section_ids=['killer_bunny', 'brian', 'brian', 'shrubbery'],
+                figure_ids=['brian', 'balloon', 'ex-parrot'],
+                table_ids=['balloon', 'airship'])
+        check_id_uniqueness(state)
+        self.assertEqual(state.section_ids, ['killer_bunny', 'shrubbery'])
+        self.assertEqual(state.figure_ids, ['ex-parrot'])
+        self.assertEqual(state.table_ids, ['airship'])
+
+
+    def test_map_ids_to_types(self):
+        state = XrefState(section_ids=['sec1'], equation_ids=['eq1'],
+                          figure_ids=['fig1', 'fig2'], table_ids=['tab1'])
+        map_ids_to_types(state)
+        self.assertEqual(state.id_to_type, {'sec1': 'section',
+                                            'eq1': 'equation',
+                                            'fig1': 'figure',
+                                            'fig2': 'figure',
+                                            'tab1': 'table'})
 
 
     # Tests for resolving cross-references ------------------------------------
@@ -168,9 +174,8 @@ class TestPandocXrefNative(unittest.TestCase):
 
 
     def test_crossref_check(self):
-        reset_idlists()
-        section_ids[:] = ['id']
-        table_ids[:] = ['tab:id']
+        state = XrefState(section_ids=['id'], table_ids=['tab:id'])
+        map_ids_to_types(state)
         tests = [('-[@#id.', False),
                  ('[@#id].', False),
                  ('@#id', True),
@@ -182,14 +187,14 @@ class TestPandocXrefNative(unittest.TestCase):
                  ('[@#id', True),
                  ('@#tab:id]', False)] # bracketed ids must be of same type
         for cross_ref_str, valid in tests:
-            cross_ref = CrossRef.match(cross_ref_str)
+            cross_ref = CrossRef.match(cross_ref_str, state)
             msg_dict = { True: 'valid', False: 'invalid' }
             self.assertEqual(cross_ref.valid, valid,
                 msg=(f'Expected cross-reference "{cross_ref_str}" to be '
                      f'{msg_dict[valid]}, but it turned out to be '
                      f'{msg_dict[cross_ref.valid]}! '
-                     f'`CrossRef.inside_brackets` is '
-                     f'{str(CrossRef.inside_brackets)}.') )
+                     f'`state.inside_brackets` is '
+                     f'{str(state.inside_brackets)}.') )
 
 
     def test_new_sentence(self):
@@ -209,10 +214,8 @@ class TestPandocXrefNative(unittest.TestCase):
 
 
     def test_resolve_crossrefs(self):
-        reset_idlists()
-        CrossRef.reset_bracket_states()
-        equation_ids[:] = ['eq1']
-        figure_ids[:] = ['fig1', 'fig2']
+        state = XrefState(equation_ids=['eq1'], figure_ids=['fig1', 'fig2'])
+        map_ids_to_types(state)
         tests = [
          ['See @#fig1.',
           'See `<a href=#fig1 class="cross-ref include-type">??</a>`{=html}.'],
@@ -243,11 +246,40 @@ class TestPandocXrefNative(unittest.TestCase):
         ]
         for pdc, exp_pdc in [*tests]:
             doc = pandoc(pdc, para=False)
-            new_doc = walk(doc, resolve_crossrefs, None, None)
+            apply_filter(partial(resolve_crossrefs, state), doc, None)
             exp_doc = pandoc(exp_pdc, para=False)
             # Using depandoc instead of the AST versions improves readability
             # greatly if the test fails.
-            self.assertEqual(depandoc(new_doc), depandoc(exp_doc))
+            self.assertEqual(depandoc(doc), depandoc(exp_doc))
+
+
+    # Tests for main function and utilities ----------------------------------
+
+    def test_iter_elements(self):
+        code = {'t': 'Code', 'c': [mock_attr(''), '@#id']}
+        # The contents of opaque elements such as Math must not be traversed.
+        math = {'t': 'Math', 'c': [{'t': 'InlineMath'}, 'x']}
+        emph = {'t': 'Emph', 'c': [{'t': 'Str', 'c': 'emph'}]}
+        para = {'t': 'Para', 'c': [{'t': 'Str', 'c': 'A'}, code, math, emph]}
+        doc = {'meta': {'title': {'t': 'MetaInlines',
+                                  'c': [{'t': 'Str', 'c': 'Title'}]}},
+               'blocks': [para]}
+        self.assertEqual([ elt['t'] for elt in iter_elements(doc) ],
+                         ['Str', 'Para', 'Str', 'Code', 'Math', 'Emph', 'Str'])
+
+
+    def test_main_deeply_nested(self):
+        # Documents this deeply nested cannot be serialized by orjson, so the
+        # filter needs to fall back to the json module.
+        block = {'t': 'Para', 'c': [{'t': 'Str', 'c': 'Deep.'}]}
+        for _ in range(130):
+            block = {'t': 'BlockQuote', 'c': [block]}
+        doc = {'pandoc-api-version': [1, 23], 'meta': {}, 'blocks': [block]}
+        _filter = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'pandoc_xref_native.py')
+        output = subprocess.check_output([sys.executable, _filter],
+                                         input=json.dumps(doc), text=True)
+        self.assertEqual(json.loads(output), doc)
 
 
 # -----------------------------------------------------------------------------